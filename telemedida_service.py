@@ -11,8 +11,9 @@ from urllib.parse import quote_plus
 import gspread
 import pandas as pd
 from google.oauth2.service_account import Credentials
-from gspread.utils import rowcol_to_a1
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
 from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
 
 # Evita depender de gspread.models (no existe en versiones actuales)
 Worksheet = Any
@@ -49,7 +50,8 @@ class TelemedidaService:
         self.db_password = os.getenv('DB_PASSWORD')
         self.db_host = os.getenv('DB_HOST')
         self.db_port = int(os.getenv('DB_PORT', '5432'))
-        self.db_metersight = os.getenv('DB_METERSIGHT')
+        # Servidor dblink (foreign server + user mapping) hacia la base de datos metersight
+        self.db_metersight_server = os.getenv('DB_METERSIGHT_SERVER', 'metersight_srv')
         self.db_app_ops = os.getenv('DB_APP_OPS')
         
         # Google Sheets
@@ -62,7 +64,7 @@ class TelemedidaService:
         
         # Validar configuración requerida
         required_vars = [
-            'DB_PASSWORD', 'DB_HOST', 'DB_METERSIGHT', 'DB_APP_OPS',
+            'DB_PASSWORD', 'DB_HOST', 'DB_APP_OPS',
             'GOOGLE_SHEETS_ID', 'GOOGLE_SERVICE_ACCOUNT_JSON'
         ]
         missing_vars = [var for var in required_vars if not os.getenv(var)]
@@ -73,10 +75,9 @@ class TelemedidaService:
         """Configura las conexiones a las bases de datos"""
         password_encoded = quote_plus(self.db_password)
         
-        url_metersight = f"postgresql://{self.db_username}:{password_encoded}@{self.db_host}:{self.db_port}/{self.db_metersight}"
+        # metersight se consulta vía dblink desde app_ops, no necesita engine propio
         url_app_ops = f"postgresql://{self.db_username}:{password_encoded}@{self.db_host}:{self.db_port}/{self.db_app_ops}"
         
-        self.engine_metersight = self.conexion_db(url_metersight)
         self.engine_app_ops = self.conexion_db(url_app_ops)
         
     def setup_google_sheets(self):
@@ -104,52 +105,89 @@ class TelemedidaService:
     def conexion_db(self, conn_string):
         """Función de conexión a base de datos"""
         try:
-            engine = create_engine(conn_string)
-            with engine.connect() as connection:
-                self.logger.info("Conexión a la base de datos establecida y probada exitosamente.")
+            # NullPool: sin pool de conexiones de servidor de larga duración; cada consulta
+            # abre su propia conexión y la cierra al terminar.
+            # No se abre una conexión de prueba: si la base de datos no es accesible,
+            # el error aparece en la primera consulta, al fallar connect().
+            engine = create_engine(
+                conn_string,
+                poolclass=NullPool,
+                connect_args={"connect_timeout": 5},
+            )
+            self.logger.info("Motor de base de datos creado (la conexión se abre en la primera consulta).")
             return engine
         except Exception as e:
-            self.logger.error(f"Error al crear o probar conexión a la base de datos: {e}")
+            self.logger.error(f"Error al crear el motor de base de datos: {e}")
             raise
             
     def extract_data_from_databases(self):
-        """Extrae datos de las bases de datos"""
-        query_metersight = text("""
-            SELECT
-                read_timestamp - interval '5 hour' AS read_timestamp_local,
-                user_email,
-                success,
-                error,
-                client_number,
-                meter_factor,
-                brand,
-                serial,
-                ip
-            FROM cgm.metersight
-            WHERE read_timestamp > :fecha AND  read_timestamp < :fecha + interval '1 day'
-        """)
-
-        query_app_ops = text("""
+        """Extrae la lectura más reciente por cliente de ambas fuentes en una sola consulta"""
+        # metersight se lee vía dblink desde app_ops: una sola conexión y una sola consulta.
+        # Las columnas de metersight viajan como texto (la lista AS t (...) coincide por
+        # construcción sea cual sea su tipo real); success y meter_factor quedan como texto en
+        # ambas fuentes y read_timestamp se convierte a timestamp localmente.
+        # La deduplicación (lectura más reciente por cliente) se hace en SQL con DISTINCT ON:
+        # primero en cada fuente (metersight ya en el servidor remoto, menos filas por dblink)
+        # y después entre ambas fuentes.
+        query_lecturas = text("""
             WITH info_visit AS (
                 SELECT * FROM visits
             ),
+            metersight AS (
+                SELECT *
+                FROM dblink(
+                    :dblink_metersight,
+                    format(
+                        $q$
+                            SELECT DISTINCT ON (client_number)
+                                read_timestamp::text AS read_timestamp,
+                                user_email::text     AS user_email,
+                                success::text        AS success,
+                                error::text          AS error,
+                                client_number::text  AS client_number,
+                                meter_factor::text   AS meter_factor,
+                                brand::text          AS brand,
+                                serial::text         AS serial,
+                                ip::text             AS ip
+                            FROM cgm.metersight
+                            WHERE read_timestamp > %L AND  read_timestamp < %L::timestamptz + interval '1 day'
+                            ORDER BY client_number, read_timestamp DESC
+                        $q$,
+                        CAST(:fecha AS timestamptz), CAST(:fecha AS timestamptz)
+                    )
+                ) AS t (
+                    read_timestamp TEXT,
+                    user_email     TEXT,
+                    success        TEXT,
+                    error          TEXT,
+                    client_number  TEXT,
+                    meter_factor   TEXT,
+                    brand          TEXT,
+                    serial         TEXT,
+                    ip             TEXT
+                )
+            ),
             meter_reading AS (
                 SELECT *
                 FROM dblink(
                     'dbname=bia-bi password=SlKJOH602q87f7enwyCAGRra user=data',
-                    $$
-                        SELECT
-                            visit_id,
-                            read_timestamp,
-                            user_id,
-                            success,
-                            error,
-                            meter_factor,
-                            brand,
-                            serial,
-                            ip
-                        FROM telemetry.meter_readings
-                    $$
+                    format(
+                        $q$
+                            SELECT
+                                visit_id,
+                                read_timestamp,
+                                user_id,
+                                success,
+                                error,
+                                meter_factor,
+                                brand,
+                                serial,
+                                ip
+                            FROM telemetry.meter_readings
+                            WHERE read_timestamp > %L AND  read_timestamp < %L::timestamptz + interval '1 day'
+                        $q$,
+                        CAST(:fecha AS timestamptz), CAST(:fecha AS timestamptz)
+                    )
                 ) AS t (
                     visit_id      TEXT,
                     read_timestamp TIMESTAMP,
@@ -161,98 +199,141 @@ class TelemedidaService:
                     serial         TEXT,
                     ip             TEXT
                 )
+            ),
+            app_ops_visitas AS (
+                SELECT
+                    mr.read_timestamp,
+                    mr.user_id AS user_email,
+                    mr.success,
+                    mr.error,
+                    iv.internal_bia_code AS client_number,
+                    mr.meter_factor,
+                    mr.brand,
+                    mr.serial,
+                    mr.ip,
+                    iv.id AS visit_id
+                FROM meter_reading mr
+                LEFT JOIN info_visit iv
+                    ON iv.id::TEXT = mr.visit_id::TEXT
+            ),
+            app_ops AS (
+                SELECT DISTINCT ON (client_number) *
+                FROM app_ops_visitas
+                ORDER BY client_number, read_timestamp DESC
+            ),
+            lecturas AS (
+                SELECT
+                    read_timestamp::timestamptz::timestamp AS read_timestamp,
+                    user_email,
+                    success,
+                    error,
+                    client_number,
+                    meter_factor,
+                    brand,
+                    serial,
+                    ip
+                FROM metersight
+                UNION ALL
+                SELECT
+                    read_timestamp,
+                    user_email,
+                    success::text,
+                    error,
+                    client_number,
+                    meter_factor::text,
+                    brand,
+                    serial,
+                    ip
+                FROM app_ops
+            ),
+            unicas AS (
+                SELECT DISTINCT ON (client_number)
+                    read_timestamp - interval '5 hour' AS read_timestamp_local,
+                    user_email,
+                    success,
+                    error,
+                    client_number,
+                    meter_factor,
+                    brand,
+                    serial,
+                    ip
+                FROM lecturas
+                WHERE client_number IS NOT NULL
+                ORDER BY client_number, read_timestamp DESC
+            ),
+            -- Lecturas de app_ops descartadas por no tener ID Interno (siempre una fila)
+            descartadas AS (
+                SELECT
+                    COUNT(*) FILTER (WHERE visit_id IS NULL) AS lecturas_sin_visita,
+                    COUNT(*) FILTER (WHERE visit_id IS NOT NULL AND client_number IS NULL) AS lecturas_sin_codigo
+                FROM app_ops_visitas
             )
             SELECT
-                read_timestamp - interval '5 hour' AS read_timestamp_local,
-                user_id,
-                success,
-                error,
-                internal_bia_code,
-                meter_factor,
-                brand,
-                serial,
-                ip
-            FROM meter_reading mr
-            LEFT JOIN info_visit iv
-                ON iv.id::TEXT = mr.visit_id::TEXT
-            WHERE read_timestamp > :fecha AND  read_timestamp < :fecha + interval '1 day'
-            ORDER BY 2 DESC
+                u.*,
+                d.lecturas_sin_visita,
+                d.lecturas_sin_codigo
+            FROM descartadas d
+            LEFT JOIN unicas u ON TRUE
         """)
 
-        # Ejecutar consultas con manejo de errores
         try:
-            self.logger.info("Ejecutando consulta en base de datos metersight...")
-            df_metersight = pd.read_sql(query_metersight, con=self.engine_metersight, params={"fecha": self.fecha_filtro})
-            self.logger.info(f"Consulta metersight completada: {len(df_metersight)} registros")
-        except Exception as e:
-            self.logger.error(f"Error en consulta metersight: {str(e)}")
-            raise Exception(f"Error extrayendo datos de metersight: {str(e)}")
-        
-        try:
-            self.logger.info("Ejecutando consulta en base de datos app_ops...")
-            df_app_ops = pd.read_sql(query_app_ops, con=self.engine_app_ops, params={"fecha": self.fecha_filtro})
-            self.logger.info(f"Consulta app_ops completada: {len(df_app_ops)} registros")
+            self.logger.info("Ejecutando consulta combinada (metersight + app_ops)...")
+            df_lecturas = pd.read_sql(
+                query_lecturas,
+                con=self.engine_app_ops,
+                params={
+                    "fecha": self.fecha_filtro,
+                    "dblink_metersight": self.db_metersight_server,
+                },
+            )
+
+            # Lecturas de app_ops sin ID Interno, descartadas en SQL. La consulta devuelve
+            # siempre al menos una fila con los conteos (con client_number NULL si no hay lecturas)
+            sin_visita = int(df_lecturas['lecturas_sin_visita'].iloc[0])
+            sin_codigo = int(df_lecturas['lecturas_sin_codigo'].iloc[0])
+            df_lecturas = df_lecturas.loc[df_lecturas['client_number'].notna()].drop(
+                columns=['lecturas_sin_visita', 'lecturas_sin_codigo']
+            )
+            self.logger.info(f"Consulta combinada completada: {len(df_lecturas)} registros")
+            if sin_visita:
+                self.logger.warning(f"Se omitieron {sin_visita} lecturas de app_ops sin visita asociada")
+            if sin_codigo:
+                self.logger.warning(f"Se omitieron {sin_codigo} lecturas de app_ops cuya visita no tiene internal_bia_code")
         except Exception as e:
-            self.logger.error(f"Error en consulta app_ops: {str(e)}")
-            raise Exception(f"Error extrayendo datos de app_ops: {str(e)}")
+            self.logger.error(f"Error en consulta combinada: {str(e)}")
+            raise Exception(f"Error extrayendo datos de metersight/app_ops: {str(e)}")
         
-        return df_metersight, df_app_ops
+        return df_lecturas
         
-    def process_data(self, df_metersight, df_app_ops):
-        """Procesa y combina los datos de ambas fuentes"""
-        # Mapeo y limpieza de datos
-        col_map = {
-            "read_timestamp": "read_timestamp",
-            "user_id":    "user_email",
-            "success": "success",
-            "error": "error",
-            "internal_bia_code": "client_number",
-            "meter_factor": "meter_factor",
-            "brand": "brand",
-            "serial": "serial",
-            "ip": "ip"
-        }
-
-        df_app_ops_renamed = df_app_ops.rename(columns=col_map)
+    def process_data(self, df_lecturas):
+        """Prepara las lecturas (ya deduplicadas por cliente en SQL)"""
+        # Asegurarnos de que la columna de fecha sea tipo datetime (read_sql ya suele
+        # devolverla así; solo se convierte si no lo es)
+        if not pd.api.types.is_datetime64_any_dtype(df_lecturas['read_timestamp_local']):
+            df_lecturas['read_timestamp_local'] = pd.to_datetime(df_lecturas['read_timestamp_local'])
 
-        # Ambas tablas mismas columnas
-        df_total = pd.concat([df_metersight, df_app_ops_renamed], ignore_index=True)
+        # Ordenar descendente por fecha (la más nueva primero) solo los registros únicos
+        df_unique = df_lecturas.sort_values('read_timestamp_local', ascending=False, ignore_index=True)
 
-        # Asegurarnos de que la columna de fecha sea tipo datetime
-        df_total['read_timestamp_local'] = pd.to_datetime(df_total['read_timestamp_local'])
-
-        # Ordenar descendente por fecha (la más nueva primero)
-        df_sorted = df_total.sort_values('read_timestamp_local', ascending=False)
-
-        # Eliminar duplicados conservando la primera aparición (la más nueva)
-        df_unique = df_sorted.drop_duplicates(subset='client_number', keep='first')
-
-        # Opcional: resetear el índice para que quede limpio
-        df_unique = df_unique.reset_index(drop=True)
+        # Valores ya formateados para la hoja, calculados por columna y no por código
+        df_unique['factor_str'] = df_unique['meter_factor'].astype(str)
+        df_unique['fecha_fmt'] = df_unique['read_timestamp_local'].dt.strftime("%m/%d/%Y")
 
         self.logger.info(f"Registros únicos: {df_unique.shape[0]}")
         return df_unique
         
-    def get_google_sheets_data(self):
-        """Obtiene datos actuales de Google Sheets"""
+    def get_google_sheets_data(self, col_index: dict) -> list:
+        """Obtiene los valores actuales de la columna ID Interno (incluye el encabezado)"""
         try:
             self.logger.info("Obteniendo datos de Google Sheets...")
-            data = self.worksheet.get_all_records()
-            df_sheet = pd.DataFrame(data)
-            self.logger.info(f"Datos obtenidos de Google Sheets: {len(df_sheet)} filas")
-            return df_sheet
+            id_vals = self.worksheet.col_values(col_index["ID Interno"])
+            self.logger.info(f"Datos obtenidos de Google Sheets: {max(len(id_vals) - 1, 0)} filas")
+            return id_vals
         except Exception as e:
             self.logger.error(f"Error obteniendo datos de Google Sheets: {str(e)}")
             raise Exception(f"Error accediendo a Google Sheets: {str(e)}")
         
     # Helper functions (mantenidas del código original)
-    def _col_to_index(self, col_letters: str) -> int:
-        """Convierte letras de columna (A, AB…) a índice 0‑based."""
-        idx = 0
-        for ch in col_letters.upper():
-            idx = idx * 26 + (ord(ch) - ord('A') + 1)
-        return idx - 1
-
     def _a1_to_grid(self, sheet_id: int, a1_range: str) -> dict:
         """Convierte un rango A1 a un dict GridRange que entiende la API de Google Sheets."""
         if ":" in a1_range:
@@ -260,80 +341,61 @@ class TelemedidaService:
         else:
             start_a1 = end_a1 = a1_range
 
-        col_start = "".join(filter(str.isalpha, start_a1))
-        col_end   = "".join(filter(str.isalpha, end_a1))
-        row_start = int("".join(filter(str.isdigit, start_a1))) - 1
-        row_end   = int("".join(filter(str.isdigit, end_a1))) - 1
+        row_start, col_start = a1_to_rowcol(start_a1)
+        row_end, col_end = a1_to_rowcol(end_a1)
 
         return {
             "sheetId": sheet_id,
-            "startRowIndex": row_start,
-            "endRowIndex":   row_end + 1,
-            "startColumnIndex": self._col_to_index(col_start),
-            "endColumnIndex":   self._col_to_index(col_end) + 1,
+            "startRowIndex": row_start - 1,
+            "endRowIndex":   row_end,
+            "startColumnIndex": col_start - 1,
+            "endColumnIndex":   col_end,
         }
 
-    def _format_date_mmddyyyy(self, dt: Union[pd.Timestamp, datetime]) -> str:
-        """Formatea una fecha al estilo MM/DD/YYYY."""
-        if isinstance(dt, pd.Timestamp):
-            dt = dt.to_pydatetime()
-        return dt.strftime("%m/%d/%Y")
-
-    def buscar_fila_por_codigo(self, worksheet: Worksheet, codigo: str, col_index: dict) -> Union[int, None]:
-        """Busca código en la columna ID Interno."""
-        try:
-            cell = worksheet.find(codigo, in_column=col_index["ID Interno"])
-            self.logger.info(f"Código '{codigo}' encontrado en la fila {cell.row}.")
-            return cell.row
-        except Exception:
+    def construir_indice_filas(self, id_vals: list) -> dict:
+        """Construye el dict {ID Interno: número de fila} a partir de los datos ya cargados."""
+        indice = {}
+        # Se omite el encabezado; ante duplicados se conserva la primera fila, como worksheet.find
+        for fila, valor in enumerate(id_vals[1:], start=2):
+            if valor:
+                indice.setdefault(valor, fila)
+        return indice
+
+    def buscar_fila_por_codigo(self, codigo: str) -> Union[int, None]:
+        """Busca código en la columna ID Interno (índice en memoria, sin llamadas a la API)."""
+        fila = self._row_index.get(str(codigo))
+        if fila is not None:
+            self.logger.info(f"Código '{codigo}' encontrado en la fila {fila}.")
+        else:
             self.logger.warning(f"Código '{codigo}' NO encontrado.")
-            return None
+        return fila
 
     def actualizar_fila_existente(self, worksheet: Worksheet, fila: int, col_index: dict, 
                                  serial_val: str, ip_val: str, factor_val: str, brand_val: str) -> None:
         """Actualiza solo las columnas que nos interesan en la fila ya existente."""
-        # Medidor Principal
-        worksheet.update(
-            rowcol_to_a1(fila, col_index["Medidor Principal"]),
-            [[serial_val]],
-            value_input_option="USER_ENTERED",
-        )
-        self.logger.info(f"Medidor actualizado (fila {fila}) → {serial_val}")
-
-        # IP Principal
-        worksheet.update(
-            rowcol_to_a1(fila, col_index["IP Principal"]),
-            [[ip_val]],
-            value_input_option="USER_ENTERED",
-        )
-        self.logger.info(f"IP actualizado (fila {fila}) → {ip_val}")
-
-        # Factor Fx
-        worksheet.update(
-            rowcol_to_a1(fila, col_index["Factor \nFx"]),
-            [[factor_val]],
-            value_input_option="USER_ENTERED",
-        )
-        self.logger.info(f"Factor actualizado (fila {fila}) → {factor_val}")
-
-        # Marca Medidor Activo (brand) – **SIEMPRE**
-        worksheet.update(
-            rowcol_to_a1(fila, col_index["Marca Medidor Activo"]),
-            [[brand_val]],
-            value_input_option="USER_ENTERED",
+        # Un único batch_update en lugar de una petición por celda
+        # (Marca Medidor Activo se escribe **SIEMPRE**)
+        data = [
+            {"range": rowcol_to_a1(fila, col_index["Medidor Principal"]), "values": [[serial_val]]},
+            {"range": rowcol_to_a1(fila, col_index["IP Principal"]), "values": [[ip_val]]},
+            {"range": rowcol_to_a1(fila, col_index["Factor \nFx"]), "values": [[factor_val]]},
+            {"range": rowcol_to_a1(fila, col_index["Marca Medidor Activo"]), "values": [[brand_val]]},
+        ]
+        worksheet.batch_update(data, value_input_option="USER_ENTERED")
+        self.logger.info(
+            f"Fila {fila} actualizada → medidor={serial_val}, ip={ip_val}, "
+            f"factor={factor_val}, brand={brand_val}"
         )
-        self.logger.info(f"Brand actualizado (fila {fila}) → {brand_val}")
 
-    def obtener_ultima_fila_con_datos(self, worksheet: gspread.Worksheet, col_index: dict) -> int:
+    def obtener_ultima_fila_con_datos(self, id_vals: list) -> int:
         """Devuelve el número de la última fila que contiene datos en la columna ID Interno."""
-        id_vals = worksheet.col_values(col_index["ID Interno"])
         ultima = len(id_vals)
         while ultima > 1 and not id_vals[ultima - 1].strip():
             ultima -= 1
         return ultima
 
-    def copiar_pegar_de_fila_anterior(self, worksheet: Worksheet, fila_nueva: int) -> None:
-        """Copia los rangos de la fila anterior a la fila recién insertada."""
+    def copiar_pegar_de_fila_anterior(self, worksheet: Worksheet, fila_nueva: int) -> list:
+        """Construye las peticiones copyPaste de la fila anterior a la fila recién insertada."""
         sheet_id = worksheet.id
 
         pares = [
@@ -353,68 +415,57 @@ class TelemedidaService:
                 }
             })
 
-        worksheet.spreadsheet.batch_update({"requests": peticiones})
-        self.logger.info(f"Copiado de rangos anteriores a la fila {fila_nueva}.")
+        return peticiones
 
     def insertar_fila_y_copiar_anteriores(self, worksheet: Worksheet, nueva_fila_idx: int, 
                                         encabezados: list, col_index: dict, codigo: str,
                                         serial_val: str, ip_val: str, factor_val: str, 
-                                        brand_val: str, read_timestamp_local) -> None:
-        """Inserta una fila nueva y copia datos de la fila anterior."""
-        # Insertar fila vacía
-        worksheet.insert_row(
-            [""] * len(encabezados),
-            index=nueva_fila_idx,
+                                        brand_val: str, fecha_formateada: str) -> None:
+        """Inserta una fila nueva ya rellena y encola la copia de la fila anterior.
+
+        La copia se envía junto con el resto del formato en ``enviar_peticiones_pendientes``;
+        los valores se vuelven a escribir después para que el copyPaste no los sobrescriba.
+        """
+        campos = {
+            "ID Interno": codigo,
+            "Medidor Principal": serial_val,
+            "IP Principal": ip_val,
+            "Factor \nFx": factor_val,
+            "Marca Medidor Activo": brand_val,
+        }
+
+        # Fecha Instalación (solo en inserción)
+        if "Fecha Instalación\n(MM/DD/YYYY)" in col_index:
+            campos["Fecha Instalación\n(MM/DD/YYYY)"] = fecha_formateada
+
+        # Fila completa con los campos en su posición y "" en el resto
+        fila = [""] * len(encabezados)
+        for nombre, valor in campos.items():
+            fila[col_index[nombre] - 1] = valor
+
+        # Insertar la fila ya rellena en la posición calculada
+        worksheet.insert_rows(
+            [fila],
+            row=nueva_fila_idx,
             value_input_option="USER_ENTERED",
         )
         self.logger.info(f"Fila insertada en la posición {nueva_fila_idx}")
 
         # Copiar rangos de la fila anterior
-        self.copiar_pegar_de_fila_anterior(worksheet, nueva_fila_idx)
+        self._format_requests.extend(self.copiar_pegar_de_fila_anterior(worksheet, nueva_fila_idx))
 
-        # Rellenar los campos obligatorios
-        worksheet.update(
-            rowcol_to_a1(nueva_fila_idx, col_index["ID Interno"]),
-            [[codigo]],
-            value_input_option="USER_ENTERED",
-        )
-        worksheet.update(
-            rowcol_to_a1(nueva_fila_idx, col_index["Medidor Principal"]),
-            [[serial_val]],
-            value_input_option="USER_ENTERED",
-        )
-        worksheet.update(
-            rowcol_to_a1(nueva_fila_idx, col_index["IP Principal"]),
-            [[ip_val]],
-            value_input_option="USER_ENTERED",
-        )
-        worksheet.update(
-            rowcol_to_a1(nueva_fila_idx, col_index["Factor \nFx"]),
-            [[factor_val]],
-            value_input_option="USER_ENTERED",
-        )
-        worksheet.update(
-            rowcol_to_a1(nueva_fila_idx, col_index["Marca Medidor Activo"]),
-            [[brand_val]],
-            value_input_option="USER_ENTERED",
+        # Reescribir los campos tras el copyPaste
+        self._pending_values.extend(
+            {"range": rowcol_to_a1(nueva_fila_idx, col_index[nombre]), "values": [[valor]]}
+            for nombre, valor in campos.items()
         )
         self.logger.info(f"Brand escrito en la fila {nueva_fila_idx} → {brand_val}")
-
-        # Fecha Instalación (solo en inserción)
         if "Fecha Instalación\n(MM/DD/YYYY)" in col_index:
-            fecha_formateada = self._format_date_mmddyyyy(read_timestamp_local)
-            worksheet.update(
-                rowcol_to_a1(nueva_fila_idx, col_index["Fecha Instalación\n(MM/DD/YYYY)"]),
-                [[fecha_formateada]],
-                value_input_option="USER_ENTERED",
-            )
             self.logger.info(f"Fecha instalación escrita en la fila {nueva_fila_idx} → {fecha_formateada}")
 
-    def colorear_fila_completa(self, worksheet: Worksheet, fila: int, hex_color: str = "FFFF00") -> None:
-        """Aplica un fondo de color a toda la fila indicada."""
-        encabezados = worksheet.row_values(1)
-        total_cols = len(encabezados)
-
+    def colorear_fila_completa(self, worksheet: Worksheet, fila: int, total_cols: int,
+                               hex_color: str = "FFFF00") -> dict:
+        """Construye la petición que aplica un fondo de color a toda la fila indicada."""
         request = {
             "repeatCell": {
                 "range": {
@@ -437,41 +488,35 @@ class TelemedidaService:
             }
         }
 
-        worksheet.spreadsheet.batch_update({"requests": [request]})
-        self.logger.info(f"Fila {fila} coloreada con {hex_color}.")
+        return request
 
-    def procesar_codigo(self, worksheet: Worksheet, df_sheet: pd.DataFrame, 
-                       df_unique: pd.DataFrame, codigo: str) -> bool:
+    def enviar_peticiones_pendientes(self, worksheet: Worksheet) -> None:
+        """Envía en bloque el formato (copyPaste + color) y los valores de las filas insertadas."""
+        if self._format_requests:
+            worksheet.spreadsheet.batch_update({"requests": self._format_requests})
+            self.logger.info(f"Formato aplicado: {len(self._format_requests)} peticiones en un único batch.")
+        if self._pending_values:
+            worksheet.batch_update(self._pending_values, value_input_option="USER_ENTERED")
+            self.logger.info(f"Valores de filas insertadas escritos: {len(self._pending_values)} rangos.")
+        self._format_requests = []
+        self._pending_values = []
+
+    def procesar_codigo(self, worksheet: Worksheet, registro: dict) -> bool:
         """Procesa un código individual (actualizar o insertar)"""
-        if "ID Interno" not in df_sheet.columns:
-            raise KeyError("La hoja no contiene la columna 'ID Interno'")
-
-        # Obtener datos de df_unique
-        fila_info = df_unique.loc[df_unique["client_number"] == codigo]
-        if fila_info.empty:
-            raise ValueError(f"El código {codigo} no está presente en df_unique")
-
-        serial_val = fila_info.iloc[0]["serial"]
-        ip_val = fila_info.iloc[0]["ip"]
-        factor_val = str(fila_info.iloc[0]["meter_factor"])
-        brand_val = fila_info.iloc[0]["brand"]
-        read_timestamp = fila_info.iloc[0]["read_timestamp_local"]
-
-        # Mapeo de encabezados
-        encabezados = worksheet.row_values(1)
-        col_index = {nombre: idx + 1 for idx, nombre in enumerate(encabezados)}
-
-        # Verificar columnas obligatorias
-        columnas_obligatorias = [
-            "ID Interno", "Medidor Principal", "IP Principal", 
-            "Factor \nFx", "Marca Medidor Activo"
-        ]
-        for col in columnas_obligatorias:
-            if col not in col_index:
-                raise KeyError(f"La hoja no contiene la columna '{col}'")
+        # Obtener datos del registro de df_unique
+        codigo = registro["client_number"]
+        serial_val = registro["serial"]
+        ip_val = registro["ip"]
+        factor_val = registro["factor_str"]
+        brand_val = registro["brand"]
+        fecha_formateada = registro["fecha_fmt"]
+
+        # Encabezados calculados una sola vez en process_all_codes
+        encabezados = self._encabezados
+        col_index = self._col_index
 
         # Buscar código
-        fila_en_hoja = self.buscar_fila_por_codigo(worksheet, codigo, col_index)
+        fila_en_hoja = self.buscar_fila_por_codigo(codigo)
 
         if fila_en_hoja is not None:
             # Actualizar fila existente
@@ -479,31 +524,58 @@ class TelemedidaService:
                 worksheet, fila_en_hoja, col_index, 
                 serial_val, ip_val, factor_val, brand_val
             )
-            self.colorear_fila_completa(worksheet, fila_en_hoja)
+            self._format_requests.append(
+                self.colorear_fila_completa(worksheet, fila_en_hoja, len(encabezados))
+            )
             return True
         else:
-            # Insertar nueva fila
-            ultima_fila_con_dato = self.obtener_ultima_fila_con_datos(worksheet, col_index)
-            nueva_fila_idx = ultima_fila_con_dato + 1
+            # Insertar nueva fila (posición mantenida en memoria, sin leer la columna)
+            nueva_fila_idx = self._next_insert_row
 
             self.insertar_fila_y_copiar_anteriores(
                 worksheet, nueva_fila_idx, encabezados, col_index, codigo,
-                serial_val, ip_val, factor_val, brand_val, read_timestamp
+                serial_val, ip_val, factor_val, brand_val, fecha_formateada
+            )
+            self._row_index[str(codigo)] = nueva_fila_idx
+            self._next_insert_row = nueva_fila_idx + 1
+            self._format_requests.append(
+                self.colorear_fila_completa(worksheet, nueva_fila_idx, len(encabezados))
             )
-            self.colorear_fila_completa(worksheet, nueva_fila_idx)
             return False
 
     def process_all_codes(self):
         """Procesa todos los códigos únicos encontrados en la base de datos"""
         try:
             # Extraer datos de las bases de datos
-            df_metersight, df_app_ops = self.extract_data_from_databases()
+            df_lecturas = self.extract_data_from_databases()
             
-            # Procesar y combinar datos
-            df_unique = self.process_data(df_metersight, df_app_ops)
+            # Procesar datos
+            df_unique = self.process_data(df_lecturas)
             
-            # Obtener datos actuales de Google Sheets
-            df_sheet = self.get_google_sheets_data()
+            # Mapeo de encabezados (una sola lectura para todos los códigos)
+            encabezados = self.worksheet.row_values(1)
+            col_index = {nombre: idx + 1 for idx, nombre in enumerate(encabezados)}
+
+            # Verificar columnas obligatorias
+            columnas_obligatorias = [
+                "ID Interno", "Medidor Principal", "IP Principal", 
+                "Factor \nFx", "Marca Medidor Activo"
+            ]
+            for col in columnas_obligatorias:
+                if col not in col_index:
+                    raise KeyError(f"La hoja no contiene la columna '{col}'")
+
+            self._encabezados = encabezados
+            self._col_index = col_index
+
+            # Obtener datos actuales de Google Sheets (solo la columna ID Interno)
+            id_vals = self.get_google_sheets_data(col_index)
+            self._row_index = self.construir_indice_filas(id_vals)
+            self._next_insert_row = self.obtener_ultima_fila_con_datos(id_vals) + 1
+
+            # Peticiones acumuladas que se envían en bloque al final
+            self._format_requests = []
+            self._pending_values = []
             
             # Procesar cada código
             results = {
@@ -512,9 +584,15 @@ class TelemedidaService:
                 'errors': []
             }
             
-            for client in df_unique["client_number"]:
+            # Registros como dicts: acceso directo a los valores sin pasar por pandas en cada código
+            registros = df_unique[
+                ["client_number", "serial", "ip", "factor_str", "brand", "fecha_fmt"]
+            ].to_dict("records")
+
+            for registro in registros:
+                client = registro["client_number"]
                 try:
-                    existe = self.procesar_codigo(self.worksheet, df_sheet, df_unique, client)
+                    existe = self.procesar_codigo(self.worksheet, registro)
                     
                     if existe:
                         results['updated'].append(client)
@@ -527,6 +605,15 @@ class TelemedidaService:
                     error_msg = f"Error procesando código {client}: {str(e)}"
                     results['errors'].append(error_msg)
                     self.logger.error(error_msg)
+
+            # Un fallo del envío en bloque no invalida lo ya escrito por código:
+            # se registra como error y se devuelven igualmente los conteos
+            try:
+                self.enviar_peticiones_pendientes(self.worksheet)
+            except Exception as e:
+                error_msg = f"Error aplicando formato/valores pendientes en bloque: {str(e)}"
+                results['errors'].append(error_msg)
+                self.logger.error(error_msg)
             
             return {
                 'success': True,